@@ -1,17 +1,118 @@
 import os
+import sys
 import pickle
+import socket
 import struct
 import functools
+import io
+
+_PROTO = pickle.HIGHEST_PROTOCOL
+# Length header prefixed to every message.
+_HEADER = struct.Struct('!L')
+# Sends smaller than this are joined and sent with sendall instead of sendmsg.
+_GATHER_THRESHOLD = 16384
+# sendmsg fails outright if given more buffers than IOV_MAX.
+_IOV_MAX = 1024
+# How much RPCSocket asks for while waiting on a header.
+_RECV_BUFSIZE = 65536
+# Once the message length is known, have the kernel wait for the whole body.
+# Not used on Windows, where MSG_WAITALL can block forever on a closed socket,
+# nor on socket subclasses such as ssl.SSLSocket, which reject recv flags.
+if sys.platform == 'win32':
+    _WAITALL = 0
+else:
+    _WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+# Lets RPCSocket.drain send without blocking, while leaving the socket itself
+# in blocking mode for reads. Again only used on plain sockets, as SSLSocket
+# rejects send flags.
+_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Message types.
+_SYNC = 'syncrequest'
+_ASYNC = 'asyncrequest'
+_RESP = 'response'
+_RETURN = 'return'
+_ERR = 'error'
+_UNKNOWN_ERR = 'UnknownRPCError'
+
+# The first byte of every RPCSocket message says how the rest is encoded.
+# Requests with trivial arguments skip pickle entirely.
+_TAG_PICKLE = 0  # the whole message, pickled
+_TAG_NOARGS = 1  # a request with no arguments
+_TAG_INT = 2     # a request with a single int argument
+_TAG_STR = 3     # a request with a single str argument
+# Length header and tag of a pickled message, packed in one go.
+_PICKLE_HEADER = struct.Struct('!LB')
+# Tag, index into _REQUEST_TYPES and function name reference. Function names
+# are only sent the first time they're used on a connection: after that the
+# reference is the name's index in the connection's name table. The first
+# time, the index has _NEW_NAME set, the reference is the name's length and
+# the name itself follows. Then comes the argument.
+_REQUEST = struct.Struct('!BBH')
+_NEW_NAME = 0x80
+_MAX_NAMES = 0x10000
+_REQUEST_TYPES = (_SYNC, _ASYNC)
+_REQ_TYPES = frozenset(_REQUEST_TYPES)
+_RETURN_TYPES = frozenset((_RETURN, _ERR))
+_INT = struct.Struct('!q')
+_INT_MIN = -2**63
+_INT_MAX = 2**63 - 1
+
+def _write_all(fd, data):
+    """Writes all of data to fd, retrying on short writes."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _sendall(sock, buffers):
+    """Sends all of buffers on sock.
+
+    Large sends are gathered by sendmsg rather than joined together first.
+    Below _GATHER_THRESHOLD, joining is cheaper than setting up the iovecs.
+    """
+    if sum(map(len, buffers)) < _GATHER_THRESHOLD:
+        sock.sendall(b''.join(buffers))
+        return
+
+    while buffers:
+        buffers = _unsent(buffers, _send(sock, buffers))
+
+def _send(sock, buffers, flags=0):
+    """Sends what it can of buffers in one call. Returns the bytes sent."""
+    if len(buffers) > 1:
+        try:
+            return sock.sendmsg(buffers[:_IOV_MAX], (), flags)
+        except (AttributeError, NotImplementedError):
+            # Not every socket can gather, e.g. ssl.SSLSocket has sendmsg
+            # but raises NotImplementedError.
+            pass
+    return sock.send(buffers[0], flags)
+
+def _unsent(buffers, sent):
+    """Returns what's left of buffers once the first sent bytes are gone."""
+    done = 0
+    while done < len(buffers) and sent >= len(buffers[done]):
+        sent -= len(buffers[done])
+        done += 1
+    buffers = buffers[done:]
+    # Only take a view of what's left after a short send, which is rare.
+    if sent:
+        buffers[0] = memoryview(buffers[0])[sent:]
+    return buffers
 
 class UniPipe(object):
     """A selectable unidirectional pipe, usable between processes.
 
-    All data written/read is pickled/unpickled.
+    All data written/read is pickled/unpickled. Each message is framed with a
+    4-byte length header so it can be read with as few syscalls as possible.
     """
+    __slots__ = ('_read_fd', '_write_fd', '_buff', '__is_open', '__weakref__')
+
     def __init__(self):
-        read_pipe, write_pipe = os.pipe()
-        self.read_pipe = os.fdopen(read_pipe, 'rb', 0)
-        self.write_pipe = os.fdopen(write_pipe, 'wb', 0)
+        # Raw fds rather than file objects: messages are framed and read in
+        # whole, so Python's buffered I/O would only add overhead.
+        self._read_fd, self._write_fd = os.pipe()
+        self._buff = bytearray()
         self.__is_open = True
 
     def __del__(self):
@@ -22,31 +123,65 @@ class UniPipe(object):
 
     def writable(self):
         """Sets if the pipe should be readable or writable."""
-        self.read_pipe.close()
+        self._close_read()
 
     def readable(self):
         """Sets if the pipe should be readable or writable."""
-        self.write_pipe.close()
+        self._close_write()
 
     def read(self):
-        try:
-            return pickle.load(self.read_pipe)
-        except EOFError:
-            self.read_pipe.close()
+        # Only ever read up to the end of the current message, so that data
+        # isn't left sitting in self._buff where select can't see it.
+        while len(self._buff) < 4:
+            if not self._fill(4 - len(self._buff)):
+                return None
+
+        (length,) = _HEADER.unpack_from(self._buff, 0)
+
+        while len(self._buff) < (length+4):
+            if not self._fill(length + 4 - len(self._buff)):
+                return None
+
+        with memoryview(self._buff) as view:
+            data = pickle.loads(view[4:length+4])
+        del self._buff[:]
+        return data
+
+    def _fill(self, size):
+        read = os.read(self._read_fd, size)
+        if read == b'':
+            self._close_read()
             self.__is_open = False
+            return False
+        self._buff += read
+        return True
 
     def write(self, data):
-        pickle.dump(data, self.write_pipe)
-        self.write_pipe.flush()
+        binary = pickle.dumps(data, protocol=_PROTO)
+        _write_all(self._write_fd, _HEADER.pack(len(binary)) + binary)
 
     def fileno(self):
         """Required for doing a select. See select.select documentation."""
-        return self.read_pipe.fileno()
+        return self._read_fd
+
+    def write_fileno(self):
+        """The fd to select on to wait until the pipe can be written to."""
+        return self._write_fd
 
     def close(self):
         self.__is_open = False
-        self.read_pipe.close()
-        self.write_pipe.close()
+        self._close_read()
+        self._close_write()
+
+    def _close_read(self):
+        if self._read_fd >= 0:
+            os.close(self._read_fd)
+            self._read_fd = -1
+
+    def _close_write(self):
+        if self._write_fd >= 0:
+            os.close(self._write_fd)
+            self._write_fd = -1
 
 class Pipe(object):
     """
@@ -72,7 +207,13 @@ class Pipe(object):
     >         (readable, _, _) = select.select([pipe1, pipe2], [], [])
     >         for pipe in readable:
     >             print(pipe.read())
+
+    To wait until a pipe can be written to, select on its write_fileno():
+
+    > (_, writable, _) = select.select([], [pipe1.write_fileno()], [])
     """
+    __slots__ = ('left', 'right', 'write_pipe', 'read_pipe', '__weakref__')
+
     def __init__(self):
         self.left = UniPipe()
         self.right = UniPipe()
@@ -106,18 +247,32 @@ class Pipe(object):
         """Required for select. See select.select documentation."""
         return self.read_pipe.fileno()
 
+    def write_fileno(self):
+        """The fd to select on to wait until the pipe can be written to."""
+        return self.write_pipe.write_fileno()
+
     def close(self):
         self.left.close()
         self.right.close()
 
 class RPCFuncHandler(object):
+    __slots__ = ('fun', '_cache')
+
     def __init__(self, fun):
         self.fun = fun
+        self._cache = {}
 
     def __getattr__(self, func_name):
-        return functools.partial(self.fun, func_name)
+        partial = self._cache.get(func_name)
+        if partial is None:
+            partial = functools.partial(self.fun, func_name)
+            self._cache[func_name] = partial
+        return partial
 
 class RPCClient(object):
+    __slots__ = (
+        'client_obj', 'rpc', 'handlers', 'sync', 'async', '__weakref__')
+
     def __init__(self, client_obj, handlers=None):
         self.client_obj = client_obj
         self.rpc = RPCHandler(client_obj)
@@ -133,44 +288,69 @@ class RPCClient(object):
 
     def execute(self):
         msg_type, func_name, args, kwargs = self.read()
-        assert msg_type in ['syncrequest', 'asyncrequest']
+        assert msg_type in _REQ_TYPES
         resp = self.handlers[func_name](*args, **kwargs)
-        if msg_type == 'syncrequest':
-            self.write(('response', resp))
+        if msg_type == _SYNC:
+            self.write((_RESP, resp))
 
     def _sync(self, func_name, *args, **kwargs):
-        self.write(('syncrequest', func_name, args, kwargs))
+        self.write((_SYNC, func_name, args, kwargs))
         msg = self.read()
-        while msg[0] in ['syncrequest', 'asyncrequest']:
+        msg_type = msg[0]
+        while msg_type in _REQ_TYPES:
             _, func_name, args, kwargs = msg
             resp = self.handlers[func_name](*args, **kwargs)
-            if msg[0] == 'syncrequest':
-                self.write(('response', resp))
+            if msg_type == _SYNC:
+                self.write((_RESP, resp))
             msg = self.read()
+            msg_type = msg[0]
 
-        if msg[0] == 'error':
-            if msg[1] == 'UnknownRPCError':
+        if msg_type == _ERR:
+            if msg[1] == _UNKNOWN_ERR:
                 raise UnknownRPCError
             raise RPCError(msg[1])
 
         return msg[1]
 
     def _async(self, func_name, *args, **kwargs):
-        self.write(('asyncrequest', func_name, args, kwargs))
+        self.write((_ASYNC, func_name, args, kwargs))
 
     def fileno(self):
         return self.client_obj.fileno()
 
+    def write_fileno(self):
+        return self.client_obj.write_fileno()
+
+    def has_buffered_message(self):
+        """Whether a message has already been received but not yet read.
+
+        select on fileno() can't see such messages, so check this first.
+        """
+        return False
+
     def close(self):
         self.client_obj.close()
 
     def write(self, msg):
         raise NotImplementedError
 
+    def write_deferred(self, msg):
+        """Queues msg to be sent by the next flush.
+
+        Clients that can't batch writes just send it immediately.
+        """
+        self.write(msg)
+
+    def flush(self):
+        """Sends any messages queued by write_deferred."""
+        pass
+
     def read(self):
         raise NotImplementedError
 
 class RPCPipe(RPCClient):
+    __slots__ = ('pipe',)
+
     def __init__(self, pipe, handlers=None):
         self.pipe = pipe
         super(RPCPipe, self).__init__(pipe, handlers=handlers)
@@ -182,36 +362,245 @@ class RPCPipe(RPCClient):
         return self.pipe.read()
 
 class RPCSocket(RPCClient):
+    """An RPC client over a connected stream socket.
+
+    Not thread-safe: only one thread may write to an RPCSocket at a time, as
+    writes share a Pickler and a queue of deferred messages.
+    """
+    __slots__ = (
+        'sock', '_recv_into', '_waitall', '_dontwait', '_buf', '_pending',
+        '_sbuf', '_pickler', '_names_out', '_names_in')
+
     def __init__(self, sock, handlers=None):
         if handlers is None:
             handlers = {}
         self.sock = sock
-        self.buff = b''
+        self._recv_into = sock.recv_into
+        if type(sock) is socket.socket:
+            self._waitall, self._dontwait = _WAITALL, _DONTWAIT
+        else:
+            self._waitall = self._dontwait = 0
+        # Holds a partly received message, or what's left over when more
+        # than one message arrives at once.
+        self._buf = bytearray()
+        self._pending = []
+        # Reused across writes to save setting up a Pickler per message.
+        self._sbuf = io.BytesIO()
+        self._pickler = pickle.Pickler(self._sbuf, protocol=_PROTO)
+        # Function names seen so far in each direction. See _REQUEST.
+        self._names_out = {}
+        self._names_in = []
         super(RPCSocket, self).__init__(self.sock, handlers=handlers)
 
     def write(self, msg):
-        binary = pickle.dumps(msg)
-        header = struct.pack('!L', len(binary))
-        self.sock.sendall(b'%b%b' % (header, binary))
+        header, body, new_name = self._encode(msg)
+        if self._pending:
+            self._pending.append(header)
+            self._pending.append(body)
+            self._add_name(new_name)
+            self.flush()
+            return
+
+        if len(body) < _GATHER_THRESHOLD:
+            self.sock.sendall(header + body)
+        else:
+            _sendall(self.sock, [header, body])
+        # Only once it's been sent, so that if sending fails, a retry defines
+        # the name again rather than referring to one the peer never got.
+        self._add_name(new_name)
+
+    def write_deferred(self, msg):
+        header, body, new_name = self._encode(msg)
+        self._pending.append(header)
+        self._pending.append(body)
+        # Queued messages are kept until they've been sent, in order, so the
+        # definition is bound to reach the peer before anything referring to
+        # it.
+        self._add_name(new_name)
+
+    def _encode(self, msg):
+        """Returns the header and body to send for msg.
+
+        Also returns the function name msg defines for the peer, if it's new.
+        """
+        request, new_name = self._encode_request(msg)
+        if request is not None:
+            return _HEADER.pack(len(request)), request, new_name
+        binary = self._dumps(msg)
+        header = _PICKLE_HEADER.pack(len(binary) + 1, _TAG_PICKLE)
+        return header, binary, None
+
+    def _add_name(self, name):
+        if name is not None:
+            self._names_out[name] = len(self._names_out)
+
+    def _encode_request(self, msg):
+        """Encodes a request without pickle.
+
+        Returns the encoded request, or None if msg has to be pickled whole,
+        and the function name if it isn't in the name table yet. It's up to
+        the caller to add the name once the request is safely on its way.
+        """
+        if type(msg) is not tuple or len(msg) != 4:
+            return None, None
+        msg_type, func_name, args, kwargs = msg
+        if (type(msg_type) is not str or msg_type not in _REQ_TYPES
+                or type(func_name) is not str
+                or type(args) is not tuple or len(args) > 1
+                or type(kwargs) is not dict or kwargs):
+            return None, None
+
+        if not args:
+            tag, payload = _TAG_NOARGS, b''
+        elif type(args[0]) is int and _INT_MIN <= args[0] <= _INT_MAX:
+            tag, payload = _TAG_INT, _INT.pack(args[0])
+        elif type(args[0]) is str:
+            try:
+                tag, payload = _TAG_STR, args[0].encode('utf-8')
+            except UnicodeEncodeError:
+                return None, None
+        else:
+            return None, None
 
-    def read(self):
-        while len(self.buff) < 4:
-            read = self.sock.recv(1024)
-            if read == b'':
-                return None
-            self.buff += read
+        kind = _REQUEST_TYPES.index(msg_type)
+        index = self._names_out.get(func_name)
+        if index is not None:
+            return b''.join((_REQUEST.pack(tag, kind, index), payload)), None
 
-        (length,) = struct.unpack('!L', self.buff[0:4])
+        if len(self._names_out) >= _MAX_NAMES:
+            return None, None
+        try:
+            name = func_name.encode('utf-8')
+        except UnicodeEncodeError:
+            return None, None
+        if len(name) > 0xFFFF:
+            return None, None
+        request = _REQUEST.pack(tag, kind | _NEW_NAME, len(name))
+        return b''.join((request, name, payload)), func_name
+
+    def _decode(self, view):
+        """Decodes an RPC message encoded by write."""
+        tag = view[0]
+        if tag == _TAG_PICKLE:
+            return pickle.loads(view[1:])
+
+        _, kind, name_ref = _REQUEST.unpack_from(view, 0)
+        start = _REQUEST.size
+        if kind & _NEW_NAME:
+            end = start + name_ref
+            # Decoded once per connection, so interning is cheap and makes
+            # the handler lookups identity checks.
+            func_name = sys.intern(str(view[start:end], 'utf-8'))
+            self._names_in.append(func_name)
+            start = end
+        else:
+            func_name = self._names_in[name_ref]
+
+        if tag == _TAG_NOARGS:
+            args = ()
+        elif tag == _TAG_INT:
+            args = _INT.unpack_from(view, start)
+        elif tag == _TAG_STR:
+            args = (str(view[start:], 'utf-8'),)
+        else:
+            raise ValueError('Unknown RPC message tag: %d' % tag)
+        return (_REQUEST_TYPES[kind & ~_NEW_NAME], func_name, args, {})
+
+    def _dumps(self, msg):
+        """Pickles msg using the socket's Pickler."""
+        self._sbuf.seek(0)
+        self._sbuf.truncate()
+        self._pickler.clear_memo()
+        self._pickler.dump(msg)
+        return self._sbuf.getvalue()
+
+    def flush(self):
+        pending = self._pending
+        if len(pending) > 1 and sum(map(len, pending)) < _GATHER_THRESHOLD:
+            self._pending = [b''.join(pending)]
+        # Drop only what's been sent, so if a send raises the queue still
+        # holds exactly what's left for the next flush.
+        while self._pending:
+            sent = _send(self.sock, self._pending)
+            self._pending = _unsent(self._pending, sent)
+
+    def drain(self):
+        """Sends as much of what write_deferred queued as won't block.
+
+        Returns True once nothing is left queued. Meant to be called when
+        select reports write_fileno() as writable.
+        """
+        if not self._dontwait:
+            self.flush()
+            return True
+
+        while self._pending:
+            try:
+                sent = _send(self.sock, self._pending, self._dontwait)
+            except BlockingIOError:
+                return False
+            self._pending = _unsent(self._pending, sent)
+        return True
+
+    def write_fileno(self):
+        return self.sock.fileno()
+
+    def has_buffered_message(self):
+        # Receiving a header asks for up to _RECV_BUFSIZE bytes, which can
+        # pull in following messages too.
+        buf = self._buf
+        if len(buf) < 4:
+            return False
+        (length,) = _HEADER.unpack_from(buf, 0)
+        return len(buf) >= length + 4
 
-        while len(self.buff) < (length+4):
-            read = self.sock.recv(1024)
-            if read == b'':
+    def read(self):
+        buf = self._buf
+        if not buf:
+            # Small messages usually arrive whole in one recv, in which case
+            # they're decoded straight from what was received.
+            data = self.sock.recv(_RECV_BUFSIZE)
+            if data == b'':
+                return None
+            if len(data) >= 4:
+                (length,) = _HEADER.unpack_from(data, 0)
+                if len(data) == length + 4:
+                    return self._decode(memoryview(data)[4:])
+            buf += data
+
+        while len(buf) < 4:
+            data = self.sock.recv(_RECV_BUFSIZE)
+            if data == b'':
+                return None
+            buf += data
+
+        (length,) = _HEADER.unpack_from(buf, 0)
+        end = length + 4
+
+        filled = len(buf)
+        if filled < end:
+            # Receive the rest of the body straight into place, rather than
+            # growing the buffer a chunk at a time.
+            buf.extend(bytes(end - filled))
+            try:
+                with memoryview(buf) as view:
+                    while filled < end:
+                        read = self._recv_into(
+                            view[filled:end], end - filled, self._waitall)
+                        if read == 0:
+                            break
+                        filled += read
+            finally:
+                # Drop the padding that wasn't received into, even if recv
+                # raised (e.g. on a timeout), so it isn't taken for data.
+                del buf[filled:]
+            if filled < end:
                 return None
-            self.buff += read
 
-        pick = self.buff[4:length+4]
-        self.buff = self.buff[length+4:]
-        return pickle.loads(pick)
+        with memoryview(buf) as view:
+            msg = self._decode(view[4:end])
+        del buf[:end]
+        return msg
 
 class UnknownRPCError(Exception):
     pass
@@ -220,23 +609,25 @@ class RPCError(Exception):
     pass
 
 class RPCHandler(object):
+    __slots__ = ('client_obj', '_cache')
+
     def __init__(self, client_obj):
         self.client_obj = client_obj
+        self._cache = {}
 
     def __getattr__(self, func):
-        return RPCCaller(self.client_obj, func)
-
-class RPCCaller(object):
-    def __init__(self, client_obj, func_name):
-        self.client_obj = client_obj
-        self.func_name = func_name
-
-    def __call__(self, *args, **kwargs):
-        self.client_obj.write((self.func_name, args, kwargs))
+        caller = self._cache.get(func)
+        if caller is None:
+            caller = functools.partial(self._call, func)
+            self._cache[func] = caller
+        return caller
+
+    def _call(self, func_name, *args, **kwargs):
+        self.client_obj.write((func_name, args, kwargs))
         (msg_type, msg) = self.client_obj.read()
-        assert msg_type in ['return', 'error']
-        if msg_type == 'error':
-            if msg == 'UnknownRPCError':
+        assert msg_type in _RETURN_TYPES
+        if msg_type == _ERR:
+            if msg == _UNKNOWN_ERR:
                 raise UnknownRPCError
             raise RPCError(msg)
 
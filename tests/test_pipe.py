@@ -1,4 +1,6 @@
 import unittest
+import weakref
+import select
 import multiprocessing
 
 import selectable
@@ -38,3 +40,18 @@ class TestPipe(unittest.TestCase):
         self.assertEqual(pipe.read(), ['okay', 'shutdown'])
         self.assertFalse(proc.is_alive())
         pipe.close()
+
+    def test_write_fileno(self):
+        pipe = selectable.Pipe()
+        pipe.use_left()
+        self.assertEqual(pipe.write_fileno(), pipe.left.write_fileno())
+        (_, writable, _) = select.select([], [pipe.write_fileno()], [], 0)
+        self.assertEqual(writable, [pipe.write_fileno()])
+        rpc = selectable.RPCPipe(pipe)
+        self.assertEqual(rpc.write_fileno(), pipe.write_fileno())
+        pipe.close()
+
+    def test_weakref(self):
+        pipe = selectable.Pipe()
+        self.assertIs(weakref.ref(pipe)(), pipe)
+        pipe.close()
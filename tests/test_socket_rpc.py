@@ -2,6 +2,7 @@ import multiprocessing
 import unittest
 import select
 import socket
+import threading
 import uuid
 import os
 
@@ -29,6 +30,26 @@ class ClientProc(multiprocessing.Process):
         self.client.execute() # wait for call_me_back
         sock.close()
 
+class SSLLikeSocket(socket.socket):
+    """Like ssl.SSLSocket, can't gather sends or take recv flags."""
+    def sendmsg(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if flags:
+            raise ValueError('non-zero flags not allowed')
+        return super(SSLLikeSocket, self).recv_into(buffer, nbytes)
+
+class FlakySocket(socket.socket):
+    """Times out on the first sendall, before sending anything."""
+    failed = False
+
+    def sendall(self, data, flags=0):
+        if not self.failed:
+            self.failed = True
+            raise socket.timeout
+        return super(FlakySocket, self).sendall(data, flags)
+
 class Tracker(object):
     def __init__(self):
         self.state = {
@@ -114,6 +135,181 @@ class TestSocketRPC(unittest.TestCase):
         conn1.close()
         conn2.close()
 
+    def test_large_message(self):
+        left, right = socket.socketpair()
+        server = selectable.RPCSocket(right, handlers={'echo': lambda x: x})
+        thread = threading.Thread(target=server.execute)
+        thread.daemon = True
+        thread.start()
+        client = selectable.RPCSocket(left)
+        payload = os.urandom(1024 * 1024)
+        self.assertEqual(client.sync.echo(payload), payload)
+        thread.join()
+        left.close()
+        right.close()
+
+    def test_large_message_ssl_like(self):
+        left, right = socket.socketpair()
+        left = SSLLikeSocket(fileno=left.detach())
+        server = selectable.RPCSocket(right, handlers={'echo': lambda x: x})
+        thread = threading.Thread(target=server.execute)
+        thread.daemon = True
+        thread.start()
+        client = selectable.RPCSocket(left)
+        payload = os.urandom(1024 * 1024)
+        self.assertEqual(client.sync.echo(payload), payload)
+        thread.join()
+        left.close()
+        right.close()
+
+    def test_deferred_writes(self):
+        left, right = socket.socketpair()
+        got = []
+        server = selectable.RPCSocket(right, handlers={'got': got.append})
+        client = selectable.RPCSocket(left)
+        for i in range(3):
+            client.write_deferred(('asyncrequest', 'got', (i,), {}))
+        client.flush()
+        for _ in range(3):
+            server.execute()
+        self.assertEqual(got, [0, 1, 2])
+        left.close()
+        right.close()
+
+    def test_flush_after_timeout(self):
+        left, right = socket.socketpair()
+        left.settimeout(0.2)
+        got = []
+        server = selectable.RPCSocket(right, handlers={'got': got.append})
+        client = selectable.RPCSocket(left)
+        payloads = [os.urandom(4 * 1024 * 1024), os.urandom(10)]
+        for payload in payloads:
+            client.write_deferred(('asyncrequest', 'got', (payload,), {}))
+        # Nothing is reading yet, so the socket fills up partway through.
+        self.assertRaises(socket.timeout, client.flush)
+        def serve():
+            for _ in payloads:
+                server.execute()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        client.flush()
+        thread.join(5)
+        self.assertEqual(got, payloads)
+        left.close()
+        right.close()
+
+    def test_retry_after_failed_send(self):
+        left, right = socket.socketpair()
+        left = FlakySocket(fileno=left.detach())
+        got = []
+        server = selectable.RPCSocket(
+            right, handlers={'foo': lambda: got.append('foo')})
+        client = selectable.RPCSocket(left)
+        self.assertRaises(socket.timeout, client.async.foo)
+        client.async.foo()
+        server.execute()
+        self.assertEqual(got, ['foo'])
+        left.close()
+        right.close()
+
+    def test_has_buffered_message(self):
+        left, right = socket.socketpair()
+        client = selectable.RPCSocket(left)
+        server = selectable.RPCSocket(right)
+        self.assertFalse(server.has_buffered_message())
+        client.write_deferred(('response', 1))
+        client.write_deferred(('response', 2))
+        client.flush()
+        self.assertEqual(server.read(), ('response', 1))
+        self.assertTrue(server.has_buffered_message())
+        self.assertEqual(select.select([server], [], [], 0)[0], [])
+        self.assertEqual(server.read(), ('response', 2))
+        self.assertFalse(server.has_buffered_message())
+        left.close()
+        right.close()
+
+    def test_drain(self):
+        left, right = socket.socketpair()
+        got = []
+        server = selectable.RPCSocket(right, handlers={'got': got.append})
+        thread = threading.Thread(target=server.execute)
+        thread.daemon = True
+        thread.start()
+        client = selectable.RPCSocket(left)
+        payload = os.urandom(1024 * 1024)
+        client.write_deferred(('asyncrequest', 'got', (payload,), {}))
+        while not client.drain():
+            select.select([], [client.write_fileno()], [])
+        thread.join()
+        self.assertEqual(got, [payload])
+        left.close()
+        right.close()
+
+    def test_timeout_mid_message(self):
+        # Capture what a write puts on the wire, to send it in two parts.
+        capture_left, capture_right = socket.socketpair()
+        payload = os.urandom(100)
+        selectable.RPCSocket(capture_left).write(('response', payload))
+        wire = capture_right.recv(65536)
+        capture_left.close()
+        capture_right.close()
+
+        left, right = socket.socketpair()
+        right.settimeout(0.2)
+        server = selectable.RPCSocket(right)
+        left.sendall(wire[:20])
+        self.assertRaises(socket.timeout, server.read)
+        left.sendall(wire[20:])
+        self.assertEqual(server.read(), ('response', payload))
+        left.close()
+        right.close()
+
+    def test_drain_ssl_like(self):
+        left, right = socket.socketpair()
+        left = SSLLikeSocket(fileno=left.detach())
+        got = []
+        server = selectable.RPCSocket(right, handlers={'got': got.append})
+        thread = threading.Thread(target=server.execute)
+        thread.daemon = True
+        thread.start()
+        client = selectable.RPCSocket(left)
+        payload = os.urandom(1024 * 1024)
+        client.write_deferred(('asyncrequest', 'got', (payload,), {}))
+        self.assertTrue(client.drain())
+        thread.join()
+        self.assertEqual(got, [payload])
+        left.close()
+        right.close()
+
+    def test_message_encoding(self):
+        left, right = socket.socketpair()
+        client = selectable.RPCSocket(left)
+        server = selectable.RPCSocket(right)
+        msgs = [
+            ('syncrequest', 'no_args', (), {}),
+            ('asyncrequest', 'int_arg', (-5,), {}),
+            ('syncrequest', 'big_int_arg', (2**70,), {}),
+            ('asyncrequest', 'str_arg', (u'h\xe9llo',), {}),
+            ('syncrequest', 'bool_arg', (True,), {}),
+            ('syncrequest', 'kwargs', (), {'a': 1}),
+            ('syncrequest', 'none_kwargs', (), None),
+            ('asyncrequest', 'tuple_kwargs', (1,), ()),
+            ('syncrequest', 'many_args', (1, 'two', [3]), {}),
+            ('asyncrequest', 'int_arg', (7,), {}),
+            ('syncrequest', 'many_args', (), {'b': [2]}),
+            ('response', 'my message'),
+            ('error', 'UnknownRPCError'),
+            ([1], 'a', (), {}),
+            ({'x': 1}, 2, 3, 4),
+        ]
+        for msg in msgs:
+            client.write(msg)
+        for msg in msgs:
+            self.assertEqual(repr(server.read()), repr(msg))
+        left.close()
+        right.close()
+
     def tearDown(self):
         try:
             self.socket.close()
@@ -1,4 +1,6 @@
 import unittest
+import weakref
+import select
 import threading
 import multiprocessing
 
@@ -35,6 +37,25 @@ class TestUniPipe(unittest.TestCase):
         pipe.close()
         self.assertFalse(pipe.is_open())
 
+    def test_read_after_writer_closed(self):
+        pipe = selectable.UniPipe()
+        pipe.write('hello')
+        pipe.readable()
+        self.assertEqual(pipe.read(), 'hello')
+        self.assertEqual(pipe.read(), None)
+        self.assertFalse(pipe.is_open())
+        pipe.close()
+
+    def test_write_fileno(self):
+        pipe = selectable.UniPipe()
+        (_, writable, _) = select.select([], [pipe.write_fileno()], [], 0)
+        self.assertEqual(writable, [pipe.write_fileno()])
+        pipe.write('hello')
+        (readable, _, _) = select.select([pipe], [], [], 0)
+        self.assertEqual(readable, [pipe])
+        self.assertEqual(pipe.read(), 'hello')
+        pipe.close()
+
     def test_multithreaded(self):
         self.concurrent_test(threading.Thread)
 
@@ -57,3 +78,7 @@ class TestUniPipe(unittest.TestCase):
         pipe.close()
         self.assertFalse(pipe.is_open())
 
+    def test_weakref(self):
+        pipe = selectable.UniPipe()
+        self.assertIs(weakref.ref(pipe)(), pipe)
+        pipe.close()